@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import cv2
+import numpy as np
+import torch
+from aiohttp.test_utils import TestClient, TestServer
+from torch import nn
+
+import metrics
+import server
+from encoders import ENCODERS
+from utils import MattingPredictor, MattingUNet3, SamVideoParser
+
+CLIP_SIZE = (640, 360)
+CLIP_FPS = 25
+
+
+class StubVideoParser:
+    # Stand-in for SamVideoParser: yields the same tuples as
+    # SamVideoParser.video_objects (logits at frame resolution, high-res
+    # features of shape (H*W, 1, C)), built from a gaussian blob around
+    # each object's prompt instead of running SAM2.
+    def __init__(self, feat_size=(64, 64), channels=32, seed=0):
+        self.feat_size = feat_size
+        self.channels = channels
+        self.rng = np.random.default_rng(seed)
+
+    def video(self, video: Path, points=None, box=None, start=0):
+        objects = [{"points": points, "box": box}]
+        for frame_idx, _, mask_logits, vision_feats, feat_sizes in self.video_objects(
+            video, objects, start=start
+        ):
+            yield frame_idx, mask_logits[0], vision_feats, feat_sizes
+
+    def video_objects(self, video: Path, objects, start=0):
+        frames = sorted(video.glob("*.jpg"))
+        height, width = cv2.imread(str(frames[0])).shape[:2]
+
+        centers = []
+        for obj in objects:
+            points = obj.get("points")
+            box = obj.get("box")
+            if points is not None and len(points) > 0:
+                centers.append(np.mean(np.array(points, np.float32), axis=0))
+            elif box is not None:
+                centers.append(((box[0] + box[2]) / 2, (box[1] + box[3]) / 2))
+            else:
+                centers.append((width / 2, height / 2))
+
+        obj_ids = list(range(1, len(objects) + 1))
+        ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+        sigma = min(height, width) / 4
+        for frame_idx in range(start, len(frames)):
+            shift = (frame_idx - start) * 2
+            mask_logits = np.stack(
+                [
+                    np.exp(-((xs - cx - shift) ** 2 + (ys - cy) ** 2) / (2 * sigma**2))
+                    * 20
+                    - 10
+                    for cx, cy in centers
+                ]
+            ).astype(np.float32)
+            vision_feats = [
+                self.rng.standard_normal(
+                    (self.feat_size[0] * self.feat_size[1], 1, self.channels),
+                    np.float32,
+                )
+            ]
+            yield frame_idx, obj_ids, mask_logits, vision_feats, [self.feat_size]
+
+
+class StubMattingModel(nn.Module):
+    # Stand-in for MattingUNet3 with the same forward signature and input
+    # channels, cheap enough to run on CPU.
+    def __init__(self):
+        super(StubMattingModel, self).__init__()
+        self.head = nn.Conv2d(36, 1, kernel_size=3, padding=1)
+        self.sigmoid = nn.Sigmoid()
+
+    def forward(self, image, segmentation, features):
+        x = torch.cat([image, segmentation, features], dim=1)
+        return self.sigmoid(self.head(x))
+
+
+def build_models(parser_kind: str, model_kind: str, device: str):
+    if parser_kind == "sam2":
+        parser = SamVideoParser(device)
+    else:
+        parser = StubVideoParser()
+
+    if model_kind == "checkpoint":
+        with open(server.MODEL_PATH, "rb") as fh:
+            model = torch.load(fh, weights_only=False, map_location=device)
+    elif model_kind == "unet":
+        model = MattingUNet3(use_sigmoid=True)
+    else:
+        model = StubMattingModel()
+    model = model.to(device).eval()
+
+    return parser, MattingPredictor(parser, model, device)
+
+
+def make_clip(path: Path, frames: int, seed: int):
+    rng = np.random.default_rng(seed)
+    width, height = CLIP_SIZE
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter_fourcc(*"mp4v"), CLIP_FPS, (width, height)
+    )
+    background = rng.integers(0, 255, (height, width, 3), np.uint8)
+    background = cv2.GaussianBlur(background, (0, 0), 15)
+    radius = height // 4
+    for i in range(frames):
+        frame = background.copy()
+        x = int(width / 4 + (width / 2) * i / max(frames - 1, 1))
+        cv2.circle(frame, (x, height // 2), radius, (40, 180, 220), -1)
+        frame = cv2.GaussianBlur(frame, (5, 5), 0)
+        writer.write(frame)
+    writer.release()
+
+    with open(str(path), "rb") as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def summarize(samples):
+    latencies = [s["latency"] * 1000 for s in samples if s["ok"]]
+    return {
+        "count": len(samples),
+        "errors": sum(1 for s in samples if not s["ok"]),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "mean_ms": float(np.mean(latencies)) if latencies else None,
+        "max_ms": float(np.max(latencies)) if latencies else None,
+    }
+
+
+async def timed(samples, name, request, **extra):
+    started = time.perf_counter()
+    try:
+        async with request as response:
+            body = await response.read()
+            ok = response.status == 200
+            if "X-Matting-Encode-Seconds" in response.headers:
+                extra["encode_s"] = float(response.headers["X-Matting-Encode-Seconds"])
+    except aiohttp.ClientError:
+        body, ok = b"", False
+    samples.append(
+        {
+            "endpoint": name,
+            "latency": time.perf_counter() - started,
+            "ok": ok,
+            "bytes": len(body),
+            **extra,
+        }
+    )
+
+
+async def run(client: TestClient, clips, args):
+    samples = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(coro):
+        async with semaphore:
+            await coro
+
+    async def upload(hash, path):
+        data = aiohttp.FormData()
+        data.add_field("hash", hash)
+        data.add_field("file", path.read_bytes(), filename=path.name)
+        await timed(samples, "upload", client.post("/upload", data=data))
+
+    async def frame(hash):
+        await timed(samples, "frame", client.get(f"/frame/{hash}"))
+
+    async def matting(hash):
+        finish = min(args.matting_frames, args.frames)
+        data = aiohttp.FormData()
+        data.add_field("hash", hash)
+        objects = [
+            {"points": [[x, 0.5], [x + 0.05, 0.5], [x, 0.1]], "labels": [1, 1, 0]}
+            for x in np.linspace(0.2, 0.7, args.objects)
+        ]
+        data.add_field("objects", json.dumps(objects))
+        data.add_field("start", "0")
+        data.add_field("finish", str(finish))
+        data.add_field("zero", "false")
+        data.add_field("format", args.format)
+        await timed(
+            samples, "matting", client.post("/matting", data=data), frames=finish
+        )
+
+    phases = {}
+    for name, jobs in [
+        ("upload", [upload(hash, path) for hash, path in clips]),
+        ("frame", [frame(hash) for hash, _ in clips for _ in range(args.repeat)]),
+        ("matting", [matting(hash) for hash, _ in clips for _ in range(args.repeat)]),
+    ]:
+        started = time.perf_counter()
+        await asyncio.gather(*[limited(job) for job in jobs])
+        phases[name] = time.perf_counter() - started
+
+    return samples, phases
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def stage_timings():
+    stages = {}
+    for metric in metrics.REGISTRY.metrics.values():
+        if not isinstance(metric, metrics.Histogram):
+            continue
+        count = sum(x["buckets"][-1] for x in metric.values.values())
+        total = sum(x["sum"] for x in metric.values.values())
+        stages[metric.name] = {
+            "count": count,
+            "total_s": total,
+            "mean_ms": total / count * 1000 if count else None,
+        }
+    return stages
+
+
+def report(samples, phases, args, device):
+    endpoints = {}
+    for name in ["upload", "frame", "matting"]:
+        endpoints[name] = summarize([s for s in samples if s["endpoint"] == name])
+        endpoints[name]["wall_s"] = phases[name]
+
+    matting = [s for s in samples if s["endpoint"] == "matting" and s["ok"]]
+    frames = sum(s["frames"] for s in matting)
+    endpoints["matting"]["frames"] = frames
+    endpoints["matting"]["frames_per_s"] = (
+        frames / phases["matting"] if phases["matting"] > 0 else None
+    )
+    endpoints["matting"]["frames_per_s_per_request"] = (
+        float(np.mean([s["frames"] / s["latency"] for s in matting]))
+        if matting
+        else None
+    )
+    endpoints["matting"]["output_bytes"] = (
+        float(np.mean([s["bytes"] for s in matting])) if matting else None
+    )
+    endpoints["matting"]["encode_s"] = (
+        float(np.mean([s.get("encode_s", 0) for s in matting])) if matting else None
+    )
+
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": device,
+        "params": vars(args),
+        "endpoints": endpoints,
+        "stages": stage_timings(),
+        "peak_rss_mb": rss_mb,
+    }
+
+
+async def main(args):
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+    server.logger = server.init_logger()
+    server.logger.setLevel(args.log_level)
+    server.device = device
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server.TMP_PATH = str(Path(tmp) / "matting")
+        os.makedirs(server.TMP_PATH)
+
+        server.logger.warning(f"Building models ({args.parser}/{args.model})...")
+        server.parser, server.predictor = build_models(args.parser, args.model, device)
+
+        clips_folder = Path(tmp) / "clips"
+        os.makedirs(str(clips_folder))
+        clips = []
+        for i in range(args.clips):
+            path = clips_folder / f"clip-{i}.mp4"
+            clips.append((make_clip(path, args.frames, seed=i), path))
+
+        async with TestClient(TestServer(server.create_app())) as client:
+            samples, phases = await run(client, clips, args)
+
+    return report(samples, phases, args, device)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Matting service benchmark")
+    argparser.add_argument("--clips", type=int, default=2)
+    argparser.add_argument("--frames", type=int, default=30)
+    argparser.add_argument("--matting-frames", type=int, default=10)
+    argparser.add_argument("--repeat", type=int, default=2)
+    argparser.add_argument("--concurrency", type=int, default=4)
+    argparser.add_argument("--objects", type=int, default=1)
+    argparser.add_argument("--format", choices=list(ENCODERS), default="jpeg")
+    argparser.add_argument("--parser", choices=["stub", "sam2"], default="stub")
+    argparser.add_argument(
+        "--model", choices=["stub", "unet", "checkpoint"], default="stub"
+    )
+    argparser.add_argument("--device", default=None)
+    argparser.add_argument("--output", default=None)
+    argparser.add_argument("--log-level", default="WARNING")
+    args = argparser.parse_args()
+
+    result = asyncio.run(main(args))
+
+    output = args.output
+    if output is None:
+        commit = (result["commit"] or "nocommit")[:8]
+        output = f"./bench-results/{commit}-{int(time.time())}.json"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fh:
+        json.dump(result, fh, indent=2)
+
+    print(json.dumps(result["endpoints"], indent=2))
+    print(f"peak RSS: {result['peak_rss_mb']:.1f} MB, saved to {output}")
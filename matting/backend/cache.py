@@ -0,0 +1,34 @@
+import time
+from pathlib import Path
+
+# walking the whole cache is slow, scrapes in between reuse the last result
+CACHE_USAGE_INTERVAL = 60
+
+
+class CacheUsage:
+    # Number of videos and total size of the cache folder; measure() walks
+    # the tree, so it should be run in an executor
+    def __init__(self, folder: Path, skip=()):
+        self.folder = folder
+        self.skip = set(skip)
+        self.updated = None
+        self.videos = 0
+        self.size = 0
+
+    def stale(self):
+        return (
+            self.updated is None
+            or time.monotonic() - self.updated > CACHE_USAGE_INTERVAL
+        )
+
+    def measure(self):
+        videos = 0
+        size = 0
+        for folder in self.folder.glob("*"):
+            if not folder.is_dir() or folder.name in self.skip:
+                continue
+            videos += 1
+            size += sum(x.stat().st_size for x in folder.rglob("*") if x.is_file())
+        self.videos, self.size = videos, size
+        self.updated = time.monotonic()
+        return videos, size
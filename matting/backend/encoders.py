@@ -0,0 +1,160 @@
+from pathlib import Path
+from zipfile import ZipFile, ZIP_STORED
+
+import cv2
+import numpy as np
+
+
+def entry_name(obj_ids, obj_id, name):
+    # a single object keeps the flat layout, several get a folder per obj_id
+    return name if len(obj_ids) == 1 else f"{obj_id}/{name}"
+
+
+class AlphaEncoder:
+    # Receives NxHxW uint8 alphas frame by frame (N objects, in obj_ids
+    # order) and writes them into a single output file as they come
+    format = None
+    extension = None
+    content_type = "application/octet-stream"
+
+    def __init__(self, folder: Path, obj_ids, frames: int, size, fps: float):
+        self.folder = folder
+        self.obj_ids = list(obj_ids)
+        self.frames = frames
+        self.size = size  # (width, height)
+        self.fps = fps
+        self.path = folder / f"matting.{self.extension}"
+
+    def write(self, frame_idx: int, alphas: np.ndarray):
+        raise NotImplementedError()
+
+    def close(self) -> Path:
+        raise NotImplementedError()
+
+    def abort(self):
+        # releases open handles without finishing the output; the caller
+        # removes the partial files
+        raise NotImplementedError()
+
+
+class ImageZipEncoder(AlphaEncoder):
+    extension = "zip"
+    content_type = "application/zip"
+    image_extension = None
+    params = []
+
+    def __init__(self, folder: Path, obj_ids, frames: int, size, fps: float):
+        super().__init__(folder, obj_ids, frames, size, fps)
+        self.zip = ZipFile(str(self.path), "w", ZIP_STORED)
+
+    def write(self, frame_idx: int, alphas: np.ndarray):
+        for obj_id, alpha in zip(self.obj_ids, alphas):
+            _, data = cv2.imencode(self.image_extension, alpha, self.params)
+            name = f"{frame_idx:05d}{self.image_extension}"
+            self.zip.writestr(entry_name(self.obj_ids, obj_id, name), data.tobytes())
+
+    def close(self) -> Path:
+        self.zip.close()
+        return self.path
+
+    def abort(self):
+        self.zip.close()
+
+
+class JpegZipEncoder(ImageZipEncoder):
+    format = "jpeg"
+    image_extension = ".jpg"
+
+
+class PngZipEncoder(ImageZipEncoder):
+    format = "png"
+    image_extension = ".png"
+
+
+class VideoEncoder(AlphaEncoder):
+    # lossless grayscale FFV1 in matroska, one stream per object;
+    # several objects are packed into a zip of {obj_id}.mkv
+    format = "video"
+    extension = "mkv"
+    content_type = "video/x-matroska"
+    fourcc = "FFV1"
+
+    def __init__(self, folder: Path, obj_ids, frames: int, size, fps: float):
+        super().__init__(folder, obj_ids, frames, size, fps)
+        if len(self.obj_ids) == 1:
+            self.videos = {self.obj_ids[0]: self.path}
+        else:
+            self.videos = {x: folder / f"{x}.{self.extension}" for x in self.obj_ids}
+            self.path = folder / "matting.zip"
+            self.content_type = "application/zip"
+
+        self.writers = {}
+        for obj_id, path in self.videos.items():
+            writer = cv2.VideoWriter(
+                str(path),
+                cv2.VideoWriter_fourcc(*self.fourcc),
+                fps or 25,
+                size,
+                isColor=False,
+            )
+            if not writer.isOpened():
+                self.abort()
+                raise RuntimeError(f"Cannot open {self.fourcc} writer for {path}")
+            self.writers[obj_id] = writer
+
+    def write(self, frame_idx: int, alphas: np.ndarray):
+        for obj_id, alpha in zip(self.obj_ids, alphas):
+            self.writers[obj_id].write(alpha)
+
+    def close(self) -> Path:
+        for writer in self.writers.values():
+            writer.release()
+
+        if len(self.obj_ids) > 1:
+            with ZipFile(str(self.path), "w", ZIP_STORED) as zip:
+                for obj_id, path in self.videos.items():
+                    zip.write(str(path), path.name)
+        return self.path
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.release()
+
+
+class ArrayEncoder(AlphaEncoder):
+    # uint8 array of shape (frames, objects, height, width) in .npy format
+    format = "npy"
+    extension = "npy"
+
+    def __init__(self, folder: Path, obj_ids, frames: int, size, fps: float):
+        super().__init__(folder, obj_ids, frames, size, fps)
+        self.array = np.lib.format.open_memmap(
+            str(self.path),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(frames, len(self.obj_ids), size[1], size[0]),
+        )
+        self.written = 0
+
+    def write(self, frame_idx: int, alphas: np.ndarray):
+        self.array[self.written] = alphas
+        self.written += 1
+
+    def close(self) -> Path:
+        self.array.flush()
+        if self.written < self.frames:
+            data = np.array(self.array[: self.written])
+            self.array = None
+            np.save(str(self.path), data)
+        else:
+            self.array = None
+        return self.path
+
+    def abort(self):
+        # dropping the last reference unmaps the file
+        self.array = None
+
+
+ENCODERS = {
+    x.format: x for x in [JpegZipEncoder, PngZipEncoder, VideoEncoder, ArrayEncoder]
+}
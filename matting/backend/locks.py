@@ -0,0 +1,37 @@
+import asyncio
+import fcntl
+import os
+from pathlib import Path
+
+POLL_INTERVAL = 0.05
+
+
+class FileLock:
+    # Exclusive flock on a file, shared by every worker process using the
+    # same cache folder; waiting is done with asyncio.sleep so the event
+    # loop keeps serving other requests
+    def __init__(self, path: Path):
+        self.path = path
+        self.fd = None
+
+    async def acquire(self):
+        self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except BlockingIOError:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, *args):
+        self.release()
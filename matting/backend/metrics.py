@@ -0,0 +1,219 @@
+import time
+from contextlib import contextmanager
+
+import torch
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+    return "{" + inner + "}"
+
+
+def format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def key(self, labels: dict):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {labels}")
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self.values.items()):
+            labels = format_labels(dict(zip(self.labels, key)))
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0}
+        data = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data["buckets"][i] += 1
+        data["sum"] += value
+
+    @contextmanager
+    def time(self, **labels):
+        # also shows up as a named range in torch.profiler traces
+        started = time.perf_counter()
+        with torch.profiler.record_function(self.name):
+            try:
+                yield
+            finally:
+                self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = self.header()
+        for key, data in sorted(self.values.items()):
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, data["buckets"]):
+                bucket_labels = format_labels({**labels, "le": format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {data['sum']!r}")
+            lines.append(
+                f"{self.name}_count{format_labels(labels)} {data['buckets'][-1]}"
+            )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels=()):
+    return REGISTRY.register(Gauge(name, help, labels))
+
+
+def histogram(name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def timed_iter(iterable, histogram: Histogram, **labels):
+    # observes the time spent producing each item, not the consumer's time
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        with torch.profiler.record_function(histogram.name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        histogram.observe(time.perf_counter() - started, **labels)
+        yield item
+
+
+REQUEST_SECONDS = histogram(
+    "matting_request_seconds", "Handler latency", ("handler", "status")
+)
+REQUESTS_IN_PROGRESS = gauge(
+    "matting_requests_in_progress", "Requests being handled", ("handler",)
+)
+SAM2_INIT_SECONDS = histogram(
+    "matting_sam2_init_seconds", "SAM2 predictor build and init_state"
+)
+SAM2_PROMPT_SECONDS = histogram(
+    "matting_sam2_prompt_seconds", "SAM2 segmentation of the prompt frame"
+)
+SAM2_PROPAGATE_SECONDS = histogram(
+    "matting_sam2_propagate_seconds", "SAM2 propagation, per frame"
+)
+UNET_FORWARD_SECONDS = histogram(
+    "matting_unet_forward_seconds", "Matting head forward pass, per frame"
+)
+PREDICT_FRAME_SECONDS = histogram(
+    "matting_predict_frame_seconds", "MattingPredictor.predict_frames, per frame"
+)
+ENCODE_SECONDS = histogram(
+    "matting_encode_seconds", "Frame encoding and writing", ("format",)
+)
+OUTPUT_CLOSE_SECONDS = histogram(
+    "matting_output_close_seconds", "Finalizing the result file", ("format",)
+)
+OUTPUT_BYTES = histogram(
+    "matting_output_bytes",
+    "Size of the result file",
+    ("format",),
+    buckets=[2**x for x in range(16, 32, 2)],
+)
+UPLOAD_DECODE_SECONDS = histogram(
+    "matting_upload_decode_seconds", "Decoding and resizing an uploaded video"
+)
+FRAMES_TOTAL = counter("matting_frames_total", "Frames matted")
+PROFILES_TOTAL = counter(
+    "matting_profiles_total", "Requests captured by torch.profiler"
+)
+CACHE_VIDEOS = gauge("matting_cache_videos", "Videos in the cache folder")
+CACHE_BYTES = gauge("matting_cache_bytes", "Size of the cache folder")
+CUDA_MEMORY_BYTES = gauge(
+    "matting_cuda_max_memory_allocated_bytes", "Peak CUDA memory allocated"
+)
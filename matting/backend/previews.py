@@ -0,0 +1,58 @@
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+THUMBNAIL_WIDTH = 160
+SPRITE_FRAMES = 50
+
+
+class PreviewWriter:
+    # Writes a downscaled thumbnail per frame and joins them into horizontal
+    # sprite strips of SPRITE_FRAMES thumbnails for the seek bar: frame i is
+    # in sprite i // SPRITE_FRAMES at x = (i % SPRITE_FRAMES) * thumbnail width
+    def __init__(self, folder: Path, resolution):
+        self.thumbs_folder = folder / "thumbs"
+        self.sprites_folder = folder / "sprites"
+        os.makedirs(str(self.thumbs_folder), exist_ok=True)
+        os.makedirs(str(self.sprites_folder), exist_ok=True)
+
+        width, height = resolution
+        self.size = (THUMBNAIL_WIDTH, round(height * THUMBNAIL_WIDTH / width))
+        self.count = 0
+        self.sprites = 0
+        self.strip = []
+
+    def add(self, image: np.ndarray):
+        thumb = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+        cv2.imwrite(str(self.thumbs_folder / f"{self.count:05d}.jpg"), thumb)
+        self.count += 1
+
+        self.strip.append(thumb)
+        if len(self.strip) == SPRITE_FRAMES:
+            self.flush()
+
+    def flush(self):
+        if not self.strip:
+            return
+        sprite = np.concatenate(self.strip, axis=1)
+        cv2.imwrite(str(self.sprites_folder / f"{self.sprites:03d}.jpg"), sprite)
+        self.sprites += 1
+        self.strip = []
+
+    def close(self):
+        self.flush()
+        return {
+            "thumbnail": self.size,
+            "sprite_frames": SPRITE_FRAMES,
+            "sprites": self.sprites,
+        }
+
+
+def make_previews(folder: Path, resolution):
+    # for videos uploaded before previews were generated
+    writer = PreviewWriter(folder, resolution)
+    for frame in sorted((folder / "frames").glob("*.jpg")):
+        writer.add(cv2.imread(str(frame)))
+    return writer.close()
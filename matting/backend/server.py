@@ -1,5 +1,8 @@
 from aiohttp import web
+import argparse
+import asyncio
 import os
+import shutil
 from pathlib import Path
 import cv2
 import json
@@ -7,15 +10,34 @@ from utils import MattingPredictor, SamVideoParser
 import torch
 from uuid import uuid4 as uuid
 import numpy as np
-from zipfile import ZipFile
 import logging
 from logging import Logger
+import time
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp_cors
+import metrics
+from metrics import (
+    ENCODE_SECONDS,
+    FRAMES_TOTAL,
+    OUTPUT_BYTES,
+    OUTPUT_CLOSE_SECONDS,
+    PREDICT_FRAME_SECONDS,
+    UPLOAD_DECODE_SECONDS,
+    timed_iter,
+)
+from encoders import ENCODERS
+from previews import PreviewWriter, make_previews
+from locks import FileLock
+from cache import CacheUsage
 
 TMP_PATH = "/tmp/matting"
 RESOLUTION = (768, 432)
 PORT = 8080
 MODEL_PATH = "./model/model-2.pt"
+PROFILE_HEADER = "X-Matting-Profile"
+PROFILE_FOLDER = "profiles"
+# frames, thumbnails and sprites never change for a given video hash
+CACHE_CONTROL = "public, max-age=31536000, immutable"
 
 device = "cuda"
 
@@ -25,6 +47,12 @@ routes = web.RouteTableDef()
 logger: Logger = None
 parser: SamVideoParser = None
 predictor: MattingPredictor = None
+cache_usage: CacheUsage = None
+# turned off for supervised workers, the supervisor reports the shared cache once
+cache_metrics = True
+# model work (SAM2, UNet, encoding) runs here one request at a time, like it
+# did on the event loop, without blocking frames, uploads and /ready
+model_executor = ThreadPoolExecutor(max_workers=1)
 
 
 def init_logger():
@@ -43,7 +71,8 @@ def init():
 
     logger.info("Loading model...")
     with open(MODEL_PATH, "rb") as fh:
-        model = torch.load(fh, weights_only=False)
+        model = torch.load(fh, weights_only=False, map_location=device)
+    model = model.to(device).eval()
     logger.info("Loading SAM2...")
     parser = SamVideoParser(device)
     logger.info("Creating predictor...")
@@ -71,6 +100,105 @@ class MattingResponse:
     def not_found(cls, message, data={}):
         return cls.response("not found", 404, message, data)
 
+    @classmethod
+    def bad_request(cls, message, data={}):
+        return cls.response("bad request", 400, message, data)
+
+    @classmethod
+    def conflict(cls, message, data={}):
+        return cls.response("conflict", 409, message, data)
+
+
+def route_name(request: web.Request):
+    route = request.match_info.route
+    if route.resource is None:
+        return "unmatched"
+    return route.resource.canonical
+
+
+async def profile(request: web.Request, handler):
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    request["profile"] = True
+    with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+        response = await handler(request)
+
+    folder = Path(TMP_PATH) / PROFILE_FOLDER
+    os.makedirs(str(folder), exist_ok=True)
+    name = f"{uuid()}.json"
+    prof.export_chrome_trace(str(folder / name))
+    metrics.PROFILES_TOTAL.inc()
+    logger.info(f"Profile saved to {name}")
+    logger.debug(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=20))
+
+    response.headers[PROFILE_HEADER + "-Trace"] = name
+    return response
+
+
+async def run_blocking(request: web.Request, executor, func, *args):
+    # profiled requests stay on the event loop thread, torch.profiler only
+    # records CPU ops of the thread it was started on
+    if request.get("profile"):
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, func, *args)
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    name = route_name(request)
+    status = 500
+    started = time.perf_counter()
+    metrics.REQUESTS_IN_PROGRESS.inc(handler=name)
+    try:
+        if request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true"):
+            response = await profile(request, handler)
+        else:
+            response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.REQUESTS_IN_PROGRESS.dec(handler=name)
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - started, handler=name, status=status
+        )
+
+
+async def update_cache_metrics():
+    global cache_usage
+    if cache_usage is None or cache_usage.folder != Path(TMP_PATH):
+        cache_usage = CacheUsage(Path(TMP_PATH), skip=[PROFILE_FOLDER])
+    if cache_usage.stale():
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, cache_usage.measure)
+    metrics.CACHE_VIDEOS.set(cache_usage.videos)
+    metrics.CACHE_BYTES.set(cache_usage.size)
+
+
+@routes.get("/metrics")
+async def metrics_endpoint(request: web.Request):
+    if cache_metrics:
+        await update_cache_metrics()
+    if torch.cuda.is_available():
+        metrics.CUDA_MEMORY_BYTES.set(torch.cuda.max_memory_allocated())
+    return web.Response(
+        text=metrics.REGISTRY.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+@routes.get("/profile/{name}")
+async def profile_trace(request: web.Request):
+    name = Path(request.match_info["name"]).name
+    path = Path(TMP_PATH) / PROFILE_FOLDER / name
+    if not path.is_file():
+        return MattingResponse.not_found(f"profile {name} not found")
+    return web.FileResponse(path)
+
 
 @routes.get("/ready")
 async def hello(request: web.Request):
@@ -82,51 +210,176 @@ def sigmoid(z):
     return 1 / (1 + np.exp(-z))
 
 
+def parse_objects(post):
+    # either a single set of positive "points" or a list of "objects",
+    # each with "points", optional "labels" (1 - positive, 0 - negative)
+    # and/or "box"; coordinates are normalized to 0-1
+    if post.get("objects") is not None:
+        objects = json.loads(post.get("objects"))
+    else:
+        objects = [{"points": json.loads(post.get("points"))}]
+
+    if not isinstance(objects, list) or len(objects) == 0:
+        raise ValueError("no objects")
+
+    for obj in objects:
+        points = obj.get("points") or []
+        labels = obj.get("labels")
+        box = obj.get("box")
+        if len(points) == 0 and box is None:
+            raise ValueError("object needs points or a box")
+        if labels is not None and len(labels) != len(points):
+            raise ValueError("labels and points differ in length")
+        if box is None and labels is not None and 1 not in labels:
+            raise ValueError("object needs a positive point or a box")
+
+        obj["points"] = [[p[0] * RESOLUTION[0], p[1] * RESOLUTION[1]] for p in points]
+        if box is not None:
+            obj["box"] = [
+                box[0] * RESOLUTION[0],
+                box[1] * RESOLUTION[1],
+                box[2] * RESOLUTION[0],
+                box[3] * RESOLUTION[1],
+            ]
+
+    return objects
+
+
 @routes.post("/matting")
 async def matting(request: web.Request):
     logger.info("Matting request")
     request_id = str(uuid())
     post = await request.post()
-    points = json.loads(post.get("points"))
     start = int(post.get("start"))
     finish = int(post.get("finish"))
     zero = post.get("zero") == "true"
     hash = post.get("hash")
+    if finish <= start:
+        return MattingResponse.bad_request("finish should be greater than start")
+    output_format = post.get("format", "jpeg")
+    if output_format not in ENCODERS:
+        return MattingResponse.bad_request(
+            f"Unknown format {output_format}, expected one of {list(ENCODERS)}"
+        )
+    try:
+        objects = parse_objects(post)
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+        return MattingResponse.bad_request(f"Invalid prompts: {e}")
     logger.info(f" --- hash: {hash}")
     logger.info(f" --- start: {start}")
     logger.info(f" --- finish: {finish}")
-    logger.info(f" --- points: {points}")
+    logger.info(f" --- objects: {objects}")
     logger.info(f" --- zero: {zero}")
+    logger.info(f" --- format: {output_format}")
 
-    for p in points:
-        p[0] = p[0] * RESOLUTION[0]
-        p[1] = p[1] * RESOLUTION[1]
-
-    frames_path = Path(TMP_PATH) / hash / "frames"
-    matting_path = Path(TMP_PATH) / hash / request_id
-    os.makedirs(str(matting_path))
+    folder = Path(TMP_PATH) / hash
+    if not (folder / "params.json").is_file():
+        if folder.exists():
+            return MattingResponse.conflict(f"video {hash} is still being uploaded")
+        return MattingResponse.not_found(f"video {hash} not found")
+    with open(str(folder / "params.json"), "r") as params:
+        info = json.load(params)
+
+    encoder, output_path, encode_seconds = await run_blocking(
+        request,
+        model_executor,
+        matte,
+        folder,
+        request_id,
+        objects,
+        start,
+        finish,
+        zero,
+        output_format,
+        info,
+    )
 
-    for frame_idx, matting, segment in predictor.predict_frames(
-        frames_path, points, start=start, finish=finish
-    ):
-        if zero:
-            matting[segment < 0.5] = 0
+    if output_path is None:
+        return MattingResponse.bad_request("No frames to process")
+
+    size = output_path.stat().st_size
+    OUTPUT_BYTES.observe(size, format=output_format)
+    logger.info(f" --- output: {size} bytes, encoded in {encode_seconds:.3f}s")
+
+    return web.FileResponse(
+        output_path,
+        status=200,
+        headers={
+            "Content-Type": encoder.content_type,
+            "Content-Disposition": f'attachment; filename="{output_path.name}"',
+            "X-Matting-Format": output_format,
+            "X-Matting-Size": str(size),
+            "X-Matting-Encode-Seconds": f"{encode_seconds:.6f}",
+        },
+    )
 
-        cv2.imwrite(
-            str(matting_path / f"{frame_idx:05d}.png"),
-            ((segment > 0.5) * 255).astype(np.uint8),
-        )
-        cv2.imwrite(
-            str(matting_path / f"{frame_idx:05d}.jpg"),
-            (matting * 255).astype(np.uint8),
-        )
 
-    zip_path = str(Path(TMP_PATH) / hash / "matting.zip")
-    with ZipFile(zip_path, "w") as zip:
-        for file in matting_path.glob("*.jpg"):
-            zip.write(file, os.path.basename(file))
+def matte(folder: Path, request_id, objects, start, finish, zero, output_format, info):
+    # runs in model_executor, off the event loop, so frames, uploads and
+    # health checks of other videos are served while matting
+    frames_path = folder / "frames"
+    matting_path = folder / request_id
+    os.makedirs(str(matting_path))
 
-    return web.FileResponse(zip_path, status=200)
+    encoder = None
+    encode_seconds = 0
+    output_path = None
+    try:
+        for frame_idx, obj_ids, mattings, segments in timed_iter(
+            predictor.predict_objects(frames_path, objects, start=start, finish=finish),
+            PREDICT_FRAME_SECONDS,
+        ):
+            FRAMES_TOTAL.inc()
+            if zero:
+                mattings[segments < 0.5] = 0
+
+            started = time.perf_counter()
+            alphas = (np.clip(mattings[..., 0], 0, 1) * 255).astype(np.uint8)
+            if encoder is None:
+                encoder = ENCODERS[output_format](
+                    matting_path,
+                    obj_ids,
+                    frames=min(finish, info["frames"]) - start,
+                    size=alphas.shape[1:][::-1],
+                    fps=info["fps"],
+                )
+            encoder.write(frame_idx, alphas)
+            elapsed = time.perf_counter() - started
+            ENCODE_SECONDS.observe(elapsed, format=output_format)
+            encode_seconds += elapsed
+
+        if encoder is not None:
+            with OUTPUT_CLOSE_SECONDS.time(format=output_format):
+                started = time.perf_counter()
+                output_path = encoder.close()
+                encode_seconds += time.perf_counter() - started
+    finally:
+        # on errors (and when there were no frames) release the writers and
+        # drop whatever was partially written
+        if output_path is None:
+            if encoder is not None:
+                encoder.abort()
+            shutil.rmtree(str(matting_path), ignore_errors=True)
+
+    return encoder, output_path, encode_seconds
+
+
+def cached_file(hash: str, path: Path, message: str, previews=False):
+    # files are only cached once the upload (and previews for thumbnails and
+    # sprites) is complete, a file being written could be served truncated
+    params = Path(TMP_PATH) / hash / "params.json"
+    ready = params.is_file()
+    if ready and previews:
+        with open(str(params), "r") as fh:
+            ready = "sprites" in json.load(fh)
+
+    if not ready or not path.is_file():
+        response = MattingResponse.not_found(message)
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    # FileResponse takes care of ETag / Last-Modified validation and Range
+    return web.FileResponse(path, headers={"Cache-Control": CACHE_CONTROL})
 
 
 @routes.get("/frame/{hash}")
@@ -135,18 +388,85 @@ async def first_frame(request: web.Request):
     hash = request.match_info["hash"]
     try:
         path: Path = Path(TMP_PATH) / hash / "frames" / "00000.jpg"
-        if not path.is_file():
-            return MattingResponse.not_found(f"video {hash} not found")
+        return cached_file(hash, path, f"video {hash} not found")
 
-        return web.FileResponse(path)
+    except Exception:
+        return MattingResponse.fail("Unexpected error")
+
+
+@routes.get(r"/frame/{hash}/{idx:\d+}")
+async def frame(request: web.Request):
+    hash = request.match_info["hash"]
+    idx = int(request.match_info["idx"])
+    thumbnail = request.query.get("size") == "thumbnail"
+    logger.debug(f"Frame request {hash} {idx} {'thumbnail' if thumbnail else ''}")
+    try:
+        folder = "thumbs" if thumbnail else "frames"
+        path: Path = Path(TMP_PATH) / hash / folder / f"{idx:05d}.jpg"
+        return cached_file(
+            hash, path, f"frame {idx} of {hash} not found", previews=thumbnail
+        )
 
     except Exception:
         return MattingResponse.fail("Unexpected error")
 
 
+@routes.get(r"/sprite/{hash}/{idx:\d+}")
+async def sprite(request: web.Request):
+    hash = request.match_info["hash"]
+    idx = int(request.match_info["idx"])
+    logger.debug(f"Sprite request {hash} {idx}")
+    try:
+        path: Path = Path(TMP_PATH) / hash / "sprites" / f"{idx:03d}.jpg"
+        return cached_file(
+            hash, path, f"sprite {idx} of {hash} not found", previews=True
+        )
+
+    except Exception:
+        return MattingResponse.fail("Unexpected error")
+
+
+def write_params(folder: Path, info):
+    # params.json marks a complete upload, so it's replaced atomically
+    tmp = folder / "params.json.tmp"
+    with open(str(tmp), "w") as params:
+        json.dump(info, params)
+    os.replace(str(tmp), str(folder / "params.json"))
+
+
+def decode_video(folder: Path, filename: str, size: int, hash: str):
+    # cv2 decoding and resizing run in an executor, off the event loop
+    frames_folder = folder / "frames"
+    os.makedirs(str(frames_folder))
+
+    previews = PreviewWriter(folder, RESOLUTION)
+    with UPLOAD_DECODE_SECONDS.time():
+        vidcap = cv2.VideoCapture(filename)
+        fps = vidcap.get(cv2.CAP_PROP_FPS)
+        success, image = vidcap.read()
+        count = 0
+        while success:
+            resolution = image.shape[:2][::-1]
+            image = cv2.resize(image, RESOLUTION, interpolation=cv2.INTER_LANCZOS4)
+            cv2.imwrite(str(frames_folder / f"{count:05d}.jpg"), image)
+            previews.add(image)
+            success, image = vidcap.read()
+            count += 1
+
+    return {
+        "size": size,
+        "frames": count,
+        "resolution": resolution,
+        "fps": fps,
+        "hash": hash,
+        **previews.close(),
+    }
+
+
 @routes.post("/upload")
 async def upload(request: web.Request):
     logger.info("Upload request")
+    lock = None
     try:
         reader = await request.multipart()
 
@@ -163,12 +483,23 @@ async def upload(request: web.Request):
         except Exception:
             return MattingResponse.fail("")
 
+        # other uploads of this hash, from this or another worker, wait here
+        lock = await FileLock(Path(TMP_PATH) / f"{hash}.lock").acquire()
+
         folder = Path(TMP_PATH) / hash
-        if folder.exists():
+        if (folder / "params.json").is_file():
             with open(str(folder / "params.json"), "r") as params:
                 info = json.load(params)
-                return MattingResponse.success("Already exists", info)
+            if "sprites" not in info:
+                info.update(
+                    await run_blocking(request, None, make_previews, folder, RESOLUTION)
+                )
+                write_params(folder, info)
+            return MattingResponse.success("Already exists", info)
 
+        if folder.exists():
+            logger.warning(f"Removing incomplete upload {hash}")
+            shutil.rmtree(str(folder))
         os.makedirs(str(folder))
 
         size = 0
@@ -181,42 +512,21 @@ async def upload(request: web.Request):
                 size += len(chunk)
                 f.write(chunk)
 
-        frames_folder = folder / "frames"
-        os.makedirs(str(frames_folder))
-
-        vidcap = cv2.VideoCapture(full_filename)
-        fps = vidcap.get(cv2.CAP_PROP_FPS)
-        success, image = vidcap.read()
-        count = 0
-        while success:
-            resolution = image.shape[:2][::-1]
-            image = cv2.resize(image, RESOLUTION, interpolation=cv2.INTER_LANCZOS4)
-            cv2.imwrite(str(frames_folder / f"{count:05d}.jpg"), image)
-            success, image = vidcap.read()
-            count += 1
-
-        info = {
-            "size": size,
-            "frames": count,
-            "resolution": resolution,
-            "fps": fps,
-            "hash": hash,
-        }
-
-        with open(str(folder / "params.json"), "w") as params:
-            json.dump(info, params)
+        info = await run_blocking(
+            request, None, decode_video, folder, full_filename, size, hash
+        )
+        write_params(folder, info)
 
         return MattingResponse.success("Parsed", info)
     except Exception:
         return MattingResponse.fail("Unexpected error")
+    finally:
+        if lock is not None:
+            lock.release()
 
 
-if __name__ == "__main__":
-    logger = init_logger()
-    logger.info("Starting...")
-    parser, predictor = init()
-
-    app = web.Application()
+def create_app():
+    app = web.Application(middlewares=[metrics_middleware])
     app.add_routes(routes)
 
     cors = aiohttp_cors.setup(
@@ -234,4 +544,28 @@ if __name__ == "__main__":
     for route in list(app.router.routes()):
         cors.add(route)
 
-    web.run_app(app, port=PORT)
+    return app
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Matting server")
+    argparser.add_argument("--port", type=int, default=PORT)
+    argparser.add_argument("--device", default=device)
+    argparser.add_argument("--cores", default=None, help="CPU cores, e.g. 0,1,2,3")
+    argparser.add_argument("--no-cache-metrics", action="store_true")
+    args = argparser.parse_args()
+
+    logger = init_logger()
+    logger.info(f"Starting on port {args.port}...")
+
+    device = args.device
+    cache_metrics = not args.no_cache_metrics
+    if args.cores:
+        cores = [int(x) for x in args.cores.split(",")]
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        logger.info(f"Pinned to cores {cores}")
+
+    parser, predictor = init()
+
+    web.run_app(create_app(), port=args.port)
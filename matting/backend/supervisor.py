@@ -0,0 +1,394 @@
+import argparse
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+import zlib
+from logging import Logger
+from pathlib import Path
+from urllib.parse import unquote_plus
+
+import aiohttp
+from aiohttp import web
+
+from cache import CacheUsage
+
+PORT = 8080
+TMP_PATH = "/tmp/matting"
+PROFILE_FOLDER = "profiles"
+WORKER_PORT = 8100
+MAX_BODY_PEEK = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+WATCH_INTERVAL = 1
+RESTART_DELAY = 5
+MAX_RESTARTS = 5
+# a worker that ran this long before exiting is restarted without backoff
+STABLE_SECONDS = 300
+PROBE_TIMEOUT = 2
+
+HASH_PATH = re.compile(r"^/(?:frame|sprite)/([^/]+)")
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "te",
+    "trailer",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+logger: Logger = None
+
+
+def init_logger():
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    return logger
+
+
+def split_cores(cores, count):
+    # contiguous, nearly equal core ranges; workers share cores only when
+    # there are more workers than cores
+    cores = sorted(cores)
+    if count >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(count)]
+
+    size, extra = divmod(len(cores), count)
+    res = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        res.append(cores[start:end])
+        start = end
+    return res
+
+
+class Worker:
+    def __init__(self, index: int, port: int, cores, device: str):
+        self.index = index
+        self.port = port
+        self.cores = cores
+        self.device = device
+        self.process: subprocess.Popen = None
+        self.started = None
+        self.failures = 0
+        self.restart_at = None
+        self.failed = False
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        args = [
+            sys.executable,
+            str(Path(__file__).parent / "server.py"),
+            "--port",
+            str(self.port),
+            "--device",
+            self.device,
+            "--cores",
+            ",".join(str(x) for x in self.cores),
+            "--no-cache-metrics",
+        ]
+        logger.info(f"Starting worker {self.index}: {' '.join(args)}")
+        self.process = subprocess.Popen(args, cwd=str(Path(__file__).parent))
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def find_form_hash(body: bytes, content_type: str):
+    # hash field of a (possibly incomplete) multipart or urlencoded form
+    if content_type.startswith("multipart/form-data"):
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if match is None:
+            return None
+        boundary = b"--" + match.group(1).encode()
+        # the last part may be cut off, only complete ones are looked at
+        for part in body.split(boundary)[1:-1]:
+            headers, _, value = part.partition(b"\r\n\r\n")
+            if re.search(rb'name="hash"', headers):
+                return value.rstrip(b"\r\n").decode()
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        match = re.search(rb"(?:^|&)hash=([^&]*)", body)
+        if match is not None:
+            return unquote_plus(match.group(1).decode())
+    return None
+
+
+class Router:
+    # Sends every request about a video hash to the same worker, so the
+    # worker that decoded the video also serves its frames and matting
+    def __init__(self, workers, cache: CacheUsage):
+        self.workers = workers
+        self.cache = cache
+        self.next = 0
+        self.session: aiohttp.ClientSession = None
+
+    def pick(self, hash: str):
+        if hash is None:
+            self.next = (self.next + 1) % len(self.workers)
+            return self.workers[self.next]
+        return self.workers[zlib.crc32(hash.encode()) % len(self.workers)]
+
+    async def find_hash(self, request: web.Request):
+        match = HASH_PATH.match(request.path)
+        if match is not None:
+            return match.group(1), b""
+
+        hash = request.headers.get("X-Matting-Hash") or request.query.get("hash")
+        if hash is not None or not request.body_exists:
+            return hash, b""
+
+        # peek at the body until the hash field shows up; the form puts it
+        # first, so large uploads are not buffered
+        body = b""
+        content_type = request.headers.get("Content-Type", "")
+        while len(body) < MAX_BODY_PEEK:
+            chunk = await request.content.readany()
+            if not chunk:
+                break
+            body += chunk
+            hash = find_form_hash(body, content_type)
+            if hash is not None:
+                break
+        return hash, body
+
+    async def body(self, prefix: bytes, request: web.Request):
+        if prefix:
+            yield prefix
+        while True:
+            chunk = await request.content.readany()
+            if not chunk:
+                break
+            yield chunk
+
+    async def proxy(self, request: web.Request):
+        # checked before peeking, a small body is read whole by find_hash
+        has_body = request.body_exists
+        hash, prefix = await self.find_hash(request)
+        worker = self.pick(hash)
+        logger.debug(f"{request.method} {request.path_qs} -> worker {worker.index}")
+
+        headers = {
+            k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS
+        }
+        data = self.body(prefix, request) if has_body else None
+        response = None
+        try:
+            async with self.session.request(
+                request.method,
+                worker.url + request.path_qs,
+                headers=headers,
+                data=data,
+                allow_redirects=False,
+            ) as upstream:
+                response = web.StreamResponse(
+                    status=upstream.status,
+                    headers={
+                        k: v
+                        for k, v in upstream.headers.items()
+                        if k.lower() not in HOP_HEADERS
+                    },
+                )
+                if upstream.content_length is not None:
+                    response.content_length = upstream.content_length
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientConnectionError:
+            if response is not None and response.prepared:
+                raise
+            return web.json_response(
+                {"status": "fail", "message": f"worker {worker.index} unavailable"},
+                status=503,
+            )
+
+    async def fetch(self, worker: Worker, path: str):
+        # a worker busy matting may not answer quickly, it's skipped instead
+        # of holding up the whole /ready or /metrics response
+        try:
+            async with self.session.get(
+                worker.url + path, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+            ) as response:
+                return response.status, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None, None
+
+    async def ready(self, request: web.Request):
+        responses = await asyncio.gather(
+            *[self.fetch(worker, "/ready") for worker in self.workers]
+        )
+        ready = [status == 200 for status, _ in responses]
+
+        if all(ready):
+            return web.json_response({"status": "success", "message": "ready"})
+        return web.json_response(
+            {"status": "fail", "message": "not ready", "workers": ready}, status=503
+        )
+
+    async def metrics(self, request: web.Request):
+        # every worker's samples with a worker label, grouped by metric
+        responses = await asyncio.gather(
+            *[self.fetch(worker, "/metrics") for worker in self.workers]
+        )
+        families = {}
+        for worker, (status, text) in zip(self.workers, responses):
+            if status != 200:
+                continue
+
+            label = f'worker="{worker.index}"'
+            family = None
+            for line in text.splitlines():
+                if line.startswith("# HELP "):
+                    family = families.setdefault(
+                        line.split(" ")[2], {"header": [], "samples": []}
+                    )
+                if line.startswith("#"):
+                    if line not in family["header"]:
+                        family["header"].append(line)
+                elif "{" in line:
+                    family["samples"].append(line.replace("{", "{" + label + ",", 1))
+                elif line:
+                    name, value = line.split(" ", 1)
+                    family["samples"].append(f"{name}{{{label}}} {value}")
+
+        # the cache folder is shared, so it's measured here once, not per worker
+        if self.cache.stale():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.cache.measure)
+        for name, help, value in [
+            ("matting_cache_videos", "Videos in the cache folder", self.cache.videos),
+            ("matting_cache_bytes", "Size of the cache folder", self.cache.size),
+        ]:
+            family = families.setdefault(
+                name,
+                {"header": [f"# HELP {name} {help}", f"# TYPE {name} gauge"]},
+            )
+            family["samples"] = [f"{name} {value}"]
+
+        lines = []
+        for family in families.values():
+            lines.extend(family["header"])
+            lines.extend(family["samples"])
+        return web.Response(
+            text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8"
+        )
+
+    async def watch(self):
+        # restarts exited workers with exponential backoff and gives up on a
+        # worker that keeps failing right after start (bad device, OOM, ...)
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.failed or worker.alive():
+                    continue
+
+                if worker.restart_at is not None:
+                    if now >= worker.restart_at:
+                        worker.start()
+                    continue
+
+                if now - worker.started > STABLE_SECONDS:
+                    worker.failures = 0
+                worker.failures += 1
+                code = worker.process.returncode
+                if worker.failures > MAX_RESTARTS:
+                    logger.error(
+                        f"Worker {worker.index} exited with code {code} "
+                        f"{MAX_RESTARTS} times in a row, not restarting"
+                    )
+                    worker.failed = True
+                    continue
+
+                delay = RESTART_DELAY * 2 ** (worker.failures - 1)
+                logger.warning(
+                    f"Worker {worker.index} exited with code {code}, "
+                    f"restarting in {delay}s"
+                )
+                worker.restart_at = now + delay
+
+    async def on_startup(self, app: web.Application):
+        self.session = aiohttp.ClientSession(
+            auto_decompress=False, timeout=aiohttp.ClientTimeout(total=None)
+        )
+        for worker in self.workers:
+            worker.start()
+        app["watch"] = asyncio.create_task(self.watch())
+
+    async def on_cleanup(self, app: web.Application):
+        app["watch"].cancel()
+        await self.session.close()
+        for worker in self.workers:
+            worker.stop()
+
+
+def default_devices():
+    # one worker per GPU, or a single CPU worker when there is no CUDA
+    import torch
+
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def create_app(router: Router):
+    app = web.Application()
+    app.router.add_get("/ready", router.ready)
+    app.router.add_get("/metrics", router.metrics)
+    app.router.add_route("*", "/{tail:.*}", router.proxy)
+    app.on_startup.append(router.on_startup)
+    app.on_cleanup.append(router.on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Matting server supervisor")
+    argparser.add_argument(
+        "--workers", type=int, default=None, help="defaults to one per device"
+    )
+    argparser.add_argument("--port", type=int, default=PORT)
+    argparser.add_argument("--worker-port", type=int, default=WORKER_PORT)
+    argparser.add_argument(
+        "--device",
+        default=None,
+        help="device or comma separated devices to cycle, defaults to every GPU",
+    )
+    args = argparser.parse_args()
+
+    logger = init_logger()
+
+    devices = args.device.split(",") if args.device else default_devices()
+    count = args.workers or len(devices)
+    cores = split_cores(os.sched_getaffinity(0), count)
+    workers = [
+        Worker(i, args.worker_port + i, cores[i], devices[i % len(devices)])
+        for i in range(count)
+    ]
+    logger.info(f"Starting {len(workers)} workers behind port {args.port}")
+
+    cache = CacheUsage(Path(TMP_PATH), skip=[PROFILE_FOLDER])
+    web.run_app(create_app(Router(workers, cache)), port=args.port)
@@ -0,0 +1,121 @@
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import supervisor
+from supervisor import Router, Worker, find_form_hash, split_cores
+
+
+async def echo(request: web.Request):
+    post = await request.post()
+    fields = {}
+    for name, value in post.items():
+        if isinstance(value, web.FileField):
+            fields[name] = len(value.file.read())
+        else:
+            fields[name] = value
+    return web.json_response({"path": request.path, "fields": fields})
+
+
+class ProxyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        supervisor.logger = supervisor.init_logger()
+
+        worker_app = web.Application()
+        worker_app.router.add_route("*", "/{tail:.*}", echo)
+        self.worker_server = TestServer(worker_app)
+        await self.worker_server.start_server()
+
+        # the worker process is replaced by the echo server, so the router's
+        # startup (which spawns server.py) is not used
+        worker = Worker(0, self.worker_server.port, [0], "cpu")
+        self.router = Router([worker], cache=None)
+        self.router.session = aiohttp.ClientSession(auto_decompress=False)
+
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self.router.proxy)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.router.session.close()
+        await self.worker_server.close()
+
+    async def test_small_multipart_form(self):
+        data = aiohttp.FormData()
+        data.add_field("hash", "abc")
+        data.add_field("start", "0")
+        data.add_field("finish", "10")
+        data.add_field("zero", "false")
+        data.add_field("points", "[[0.5, 0.5]]")
+        async with self.client.post("/matting", data=data) as response:
+            self.assertEqual(response.status, 200)
+            body = await response.json()
+
+        self.assertEqual(body["path"], "/matting")
+        self.assertEqual(
+            body["fields"],
+            {
+                "hash": "abc",
+                "start": "0",
+                "finish": "10",
+                "zero": "false",
+                "points": "[[0.5, 0.5]]",
+            },
+        )
+
+    async def test_small_upload(self):
+        data = aiohttp.FormData()
+        data.add_field("hash", "abc")
+        data.add_field("file", b"x" * 20 * 1024, filename="video.mp4")
+        async with self.client.post("/upload", data=data) as response:
+            self.assertEqual(response.status, 200)
+            body = await response.json()
+
+        self.assertEqual(body["fields"], {"hash": "abc", "file": 20 * 1024})
+
+    async def test_large_upload(self):
+        size = supervisor.MAX_BODY_PEEK * 4
+        data = aiohttp.FormData()
+        data.add_field("hash", "abc")
+        data.add_field("file", b"x" * size, filename="video.mp4")
+        async with self.client.post("/upload", data=data) as response:
+            self.assertEqual(response.status, 200)
+            body = await response.json()
+
+        self.assertEqual(body["fields"], {"hash": "abc", "file": size})
+
+
+class FormHashTest(unittest.TestCase):
+    def test_multipart(self):
+        body = (
+            b'--b\r\nContent-Disposition: form-data; name="hash"\r\n\r\nabc\r\n'
+            b'--b\r\nContent-Disposition: form-data; name="file"\r\n\r\nxx'
+        )
+        self.assertEqual(find_form_hash(body, "multipart/form-data; boundary=b"), "abc")
+
+    def test_incomplete_multipart(self):
+        body = b'--b\r\nContent-Disposition: form-data; name="hash"\r\n\r\nab'
+        self.assertIsNone(find_form_hash(body, "multipart/form-data; boundary=b"))
+
+    def test_urlencoded(self):
+        body = b"start=0&hash=a%20b&finish=10"
+        content_type = "application/x-www-form-urlencoded"
+        self.assertEqual(find_form_hash(body, content_type), "a b")
+
+
+class SplitCoresTest(unittest.TestCase):
+    def test_balanced(self):
+        self.assertEqual(
+            split_cores(range(10), 3), [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+        )
+
+    def test_more_workers_than_cores(self):
+        self.assertEqual(split_cores([0, 1], 3), [[0], [1], [0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,6 +17,15 @@ import numpy as np
 
 import sys
 import os
+import time
+
+from metrics import (
+    SAM2_INIT_SECONDS,
+    SAM2_PROMPT_SECONDS,
+    SAM2_PROPAGATE_SECONDS,
+    UNET_FORWARD_SECONDS,
+    timed_iter,
+)
 
 sys.path.insert(0, "../../sam2")
 
@@ -115,16 +124,42 @@ class SamVideoParser:
         self.device = device
 
     def video(self, video: Path, points=None, box=None, start=0):
-        predictor = build_sam2_video_predictor(
-            model_cfg, sam2_checkpoint, device=self.device
-        )
-
-        inference_state = predictor.init_state(video_path=str(video))
-
         if points is not None:
+            objects = [{"points": points}]
+        elif box is not None:
+            objects = [{"box": box}]
+        else:
+            raise ValueError("Either points or box is required")
+
+        for frame_idx, _, mask_logits, vision_feats, feat_sizes in self.video_objects(
+            video, objects, start=start
+        ):
+            yield frame_idx, mask_logits[0], vision_feats, feat_sizes
+
+    def video_objects(self, video: Path, objects, start=0):
+        # objects: [{"points": [[x, y], ...], "labels": [1, 0, ...], "box": ...}]
+        # labels default to positive; every object is tracked in the same
+        # propagation pass, mask_logits has one NxHxW slice per object
+        with SAM2_INIT_SECONDS.time():
+            predictor = build_sam2_video_predictor(
+                model_cfg, sam2_checkpoint, device=self.device
+            )
+            inference_state = predictor.init_state(video_path=str(video))
+
+        prompt_started = time.perf_counter()
+        for obj_id, obj in enumerate(objects, 1):
+            points = obj.get("points")
+            labels = obj.get("labels")
+            if points is not None and len(points) > 0:
+                if labels is None:
+                    labels = [1] * len(points)
+                points = np.array(points, np.float32)
+                labels = np.array(labels, np.int32)
+            else:
+                points, labels = None, None
             (
                 frame_idx,
-                _,
+                obj_ids,
                 mask_logits,
                 _,
                 vision_feats,
@@ -133,44 +168,34 @@ class SamVideoParser:
             ) = predictor.add_new_points_or_box(
                 inference_state=inference_state,
                 frame_idx=start,
-                obj_id=1,
+                obj_id=obj_id,
                 points=points,
-                labels=np.array([1] * len(points), np.int32),
+                labels=labels,
+                box=obj.get("box"),
             )
-        elif box is not None:
-            (
-                frame_idx,
-                _,
-                mask_logits,
-                _,
-                vision_feats,
-                vision_embeds,
-                feat_sizes,
-            ) = predictor.add_new_points_or_box(
-                inference_state=inference_state,
-                frame_idx=0,
-                obj_id=1,
-                box=box,
-            )
-        mask_logits = mask_logits.detach().cpu().numpy()[0, 0, :]
-        vision_feats = [x.detach().cpu().numpy() for x in vision_feats]
-        yield frame_idx, mask_logits, vision_feats, feat_sizes
-
-        for output in predictor.propagate_in_video(
-            inference_state, start_frame_idx=start + 1
+        mask_logits = mask_logits.detach().cpu().numpy()[:, 0]
+        SAM2_PROMPT_SECONDS.observe(time.perf_counter() - prompt_started)
+        # propagation expands the backbone features to one batch entry per
+        # object, they are identical, so only the first is copied to the CPU
+        vision_feats = [x[:, :1].detach().cpu().numpy() for x in vision_feats]
+        yield frame_idx, list(obj_ids), mask_logits, vision_feats, feat_sizes
+
+        for output in timed_iter(
+            predictor.propagate_in_video(inference_state, start_frame_idx=start + 1),
+            SAM2_PROPAGATE_SECONDS,
         ):
             (
                 frame_idx,
-                _,
+                obj_ids,
                 mask_logits,
                 _,
                 vision_feats,
                 vision_embeds,
                 feat_sizes,
             ) = output
-            mask_logits = mask_logits.detach().cpu().numpy()[0, 0, :]
-            vision_feats = [x.detach().cpu().numpy() for x in vision_feats]
-            yield frame_idx, mask_logits, vision_feats, feat_sizes
+            mask_logits = mask_logits.detach().cpu().numpy()[:, 0]
+            vision_feats = [x[:, :1].detach().cpu().numpy() for x in vision_feats]
+            yield frame_idx, list(obj_ids), mask_logits, vision_feats, feat_sizes
 
 
 def get_random_points(file_or_image: np.ndarray | Path | str, num_points: int):
@@ -281,10 +306,32 @@ class MattingPredictor:
         finish: int = None,
         resize_to=None,
     ):
-        images = [x for x in frames_folder.glob("*.*")]
-        for frame_idx, mask_logits, vision_feats, feat_sizes in self.parser.video(
-            frames_folder, points, start=start
+        for frame_idx, _, matting, segment in self.predict_objects(
+            frames_folder,
+            [{"points": points}],
+            start=start,
+            finish=finish,
+            resize_to=resize_to,
         ):
+            yield frame_idx, matting[0], segment[0]
+
+    @torch.no_grad()
+    def predict_objects(
+        self,
+        frames_folder: Path,
+        objects,
+        start: int = 0,
+        finish: int = None,
+        resize_to=None,
+    ):
+        images = sorted(frames_folder.glob("*.*"))
+        for (
+            frame_idx,
+            obj_ids,
+            mask_logits,
+            vision_feats,
+            feat_sizes,
+        ) in self.parser.video_objects(frames_folder, objects, start=start):
             image = cv2.imread(str(images[frame_idx]), cv2.IMREAD_UNCHANGED)
             original_size = image.shape[:2]
 
@@ -292,13 +339,19 @@ class MattingPredictor:
                 image = image[:, :, :-1]
             image = tf.to_tensor(image).to(self.device)
 
-            segment = tf.to_tensor(mask_logits).to(self.device)
+            segment = torch.from_numpy(mask_logits)[:, None].to(self.device)  # Nx1xHxW
 
-            segment -= segment.min()
-            segment /= segment.max()
+            segment -= segment.amin(dim=(1, 2, 3), keepdim=True)
+            # constant logits (object occluded or out of frame) would divide by 0
+            segment /= segment.amax(dim=(1, 2, 3), keepdim=True).clamp_min(1e-6)
 
+            # (H*W)x1xC -> 1xCxHxW, shared by all objects
+            feats = vision_feats[0]
             feats = (
-                tf.to_tensor(vision_feats[0]).view(-1, *feat_sizes[0]).to(self.device)
+                torch.from_numpy(feats)
+                .permute(1, 2, 0)
+                .reshape(1, -1, *feat_sizes[0])
+                .to(self.device)
             )
 
             if resize_to is not None:
@@ -308,17 +361,24 @@ class MattingPredictor:
             else:
                 feats = tf.resize(feats, original_size)
 
-            matting = self.model.forward(
-                image[None, :], segment[:, None], feats[None, :]
-            )
+            count = segment.shape[0]
+            with UNET_FORWARD_SECONDS.time():
+                matting = self.model.forward(
+                    image[None, :].expand(count, -1, -1, -1),
+                    segment,
+                    feats.expand(count, -1, -1, -1),
+                )
+                if str(self.device).startswith("cuda"):
+                    torch.cuda.synchronize()
 
             if resize_to is not None:
                 matting = tf.resize(matting, original_size)
 
             yield (
                 frame_idx,
-                matting[0].permute(1, 2, 0).cpu().numpy(),
-                segment.permute(1, 2, 0).cpu().numpy(),
+                obj_ids,
+                matting.permute(0, 2, 3, 1).cpu().numpy(),
+                segment.permute(0, 2, 3, 1).cpu().numpy(),
             )
 
             if frame_idx + 1 == finish: